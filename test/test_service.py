@@ -1,10 +1,21 @@
+import os
+import tempfile
 from itertools import product
+from pathlib import Path
+from typing import Dict
+from typing import List
 from typing import Optional
 
-import xml.etree.ElementTree as ET
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 import pytest
+from filelock import FileLock
+from pytest_container import Container
 from pytest_container import DerivedContainer
+from pytest_container import OciRuntimeBase
 from pytest_container.container import ContainerData
 
 
@@ -12,64 +23,203 @@ _RPMS_DIR = "/src/rpms/"
 
 _AAA_BASE_URL = "https://github.com/openSUSE/aaa_base"
 _LIBECONF_URL = "https://github.com/openSUSE/libeconf"
+_OBS_SCM_BRIDGE_URL = "https://github.com/openSUSE/obs-scm-bridge"
+_LFS_URL = "https://src.opensuse.org/pool/trivy.git"
+
+# commit of the LFS repository that is checked out by the LFS tests
+_LFS_COMMIT = "a03edab0f045ed7be68faeddef7d7ecc9416592b"
+
+# bare mirrors of the remote repositories are stored in this directory, so that
+# the tests do not need to access the network
+_MIRRORS_DIR = "/src/mirrors/"
+_LIBECONF_MIRROR = f"file://{_MIRRORS_DIR}libeconf.git"
+_OBS_SCM_BRIDGE_MIRROR = f"file://{_MIRRORS_DIR}obs-scm-bridge.git"
+
+# file in the test image recording the HEAD hashes of the ring0 submodules as
+# `$pkg_name $hash` lines
+_MANIFEST = "/src/manifest"
+
+_IMAGE_NAME = "obs-scm-bridge-test"
+
+
+def _zypper_cache_mount(cache_id: str) -> str:
+    """Build cache mount for zypper's cache. Each distribution needs its own
+    ``cache_id``, as e.g. Tumbleweed and Leap use the same repository aliases
+    and would otherwise overwrite each other's cached metadata.
+
+    """
+    return f"--mount=type=cache,id={cache_id},target=/var/cache/zypp,sharing=locked"
 
-CONTAINERFILE = f"""RUN set -eux; \
-    zypper -n in python3 git-core build diff; \
-    . /etc/os-release && [[ ${{NAME}} = "SLES" ]] || zypper -n in git-lfs; \
-    for recom in $(rpm -q --recommends build|grep ^perl); do zypper -n in $recom; done
 
-RUN git config --global user.name "SUSE Bot" && \
+# aaa_base is fetched as a submodule of ring0 from its upstream url, which is
+# redirected to the local mirror
+_GIT_CONFIG = f"""RUN git config --global user.name "SUSE Bot" && \
     git config --global user.email "noreply@suse.com" && \
-    git config --global protocol.file.allow always
+    git config --global protocol.file.allow always && \
+    git config --global submodule.fetchJobs 4 && \
+    git config --global fetch.parallel 4 && \
+    git config --global uploadpack.allowReachableSHA1InWant true && \
+    git config --global url."file://{_MIRRORS_DIR}aaa_base.git".insteadOf {_AAA_BASE_URL}
+"""
+
+# The git repositories used by the tests do not depend on the distribution, so
+# they are only created once in this image and then copied into the test images.
+_REPOS_CONTAINERFILE = f"""RUN {_zypper_cache_mount("zypp-tw")} \
+    set -eux; \
+    zypper -n modifyrepo --all --keep-packages; \
+    zypper -n in git-core git-lfs
+
+RUN git clone --mirror {_OBS_SCM_BRIDGE_URL} {_MIRRORS_DIR}obs-scm-bridge.git && \
+    git clone --mirror {_AAA_BASE_URL} {_MIRRORS_DIR}aaa_base.git && \
+    git clone --mirror {_LIBECONF_URL} {_MIRRORS_DIR}libeconf.git && \
+    git clone --mirror {_LFS_URL} {_MIRRORS_DIR}trivy.git && \
+    git -C {_MIRRORS_DIR}trivy.git lfs fetch origin HEAD {_LFS_COMMIT}
 
-RUN mkdir -p {_RPMS_DIR}ring0 && \
-    cd {_RPMS_DIR} && git clone {_LIBECONF_URL} && \
-    cd libeconf && git rev-parse HEAD > /src/libeconf && \
+# the mirrors have to be cloned before the git configuration redirects the
+# aaa_base url to its mirror
+{_GIT_CONFIG}
+
+RUN git clone --depth 1 {_LIBECONF_MIRROR} {_RPMS_DIR}libeconf
+
+RUN git init {_RPMS_DIR}ring0 && \
     cd {_RPMS_DIR}ring0 && \
-    git init && git submodule add {_AAA_BASE_URL} && \
+    git submodule add --depth 1 {_AAA_BASE_URL} && \
     git commit -m "add aaa_base" && \
     git submodule add ../libeconf && git commit -m "add libeconf" && \
-    cd aaa_base && git rev-parse HEAD > /src/aaa_base
+    echo "aaa_base $(git -C aaa_base rev-parse HEAD)" > {_MANIFEST} && \
+    echo "libeconf $(git -C libeconf rev-parse HEAD)" >> {_MANIFEST}
+"""
+
+_REPOS_TAG = f"{_IMAGE_NAME}:repos"
+
+
+def _containerfile(zypper_cache_id: str) -> str:
+    """Containerfile of the test images, using the zypper cache with the id
+    ``zypper_cache_id``.
+
+    The layers are ordered from the least to the most frequently changing one,
+    so that modifications of obs_scm_bridge do not invalidate the cached package
+    installation. zypper's cache is kept in a cache mount, so that rebuilding
+    the first layer does not download all packages again.
+
+    """
+    return f"""RUN {_zypper_cache_mount(zypper_cache_id)} \
+    set -eux; \
+    zypper -n modifyrepo --all --keep-packages; \
+    zypper -n in python3 git-core build diff; \
+    . /etc/os-release && [[ ${{NAME}} = "SLES" ]] || zypper -n in git-lfs; \
+    for recom in $(rpm -q --recommends build|grep ^perl); do zypper -n in $recom; done
+
+{_GIT_CONFIG}
+
+COPY --from={_REPOS_TAG} /src /src
 
 COPY obs_scm_bridge /usr/bin/
 RUN chmod +x /usr/bin/obs_scm_bridge
 """
 
-TUMBLEWEED = DerivedContainer(
-    base="registry.opensuse.org/opensuse/tumbleweed", containerfile=CONTAINERFILE
-)
-LEAP_LATEST = DerivedContainer(
-    base="registry.opensuse.org/opensuse/leap:15.5",
-    containerfile=CONTAINERFILE,
+
+_TUMBLEWEED_BASE = Container(url="registry.opensuse.org/opensuse/tumbleweed")
+_LEAP_LATEST_BASE = Container(url="registry.opensuse.org/opensuse/leap:15.5")
+_BCI_BASE_LATEST_BASE = Container(url="registry.suse.com/bci/bci-base:15.5")
+
+_REPOS_BUILD = DerivedContainer(
+    base=_TUMBLEWEED_BASE,
+    containerfile=_REPOS_CONTAINERFILE,
+    add_build_tags=[_REPOS_TAG],
 )
 
-BCI_BASE_LATEST = DerivedContainer(
-    base="registry.suse.com/bci/bci-base:15.5", containerfile=CONTAINERFILE
+
+class _TestImage(DerivedContainer):
+    """Image in which the tests are run. It copies the git repositories from the
+    repositories image, so that one is built first.
+
+    pytest_container only prepares an image when a test launches a container
+    from it, so only the images used by the selected tests are built. The lock
+    pytest_container holds while doing so is per test image, so the
+    repositories image is built under its own lock, as the xdist workers could
+    otherwise build it concurrently.
+
+    """
+
+    def prepare_container(
+        self,
+        container_runtime: OciRuntimeBase,
+        rootdir: Path,
+        extra_build_args: Optional[List[str]] = None,
+    ) -> None:
+        with FileLock(Path(tempfile.gettempdir()) / _REPOS_BUILD.filelock_filename):
+            _REPOS_BUILD.prepare_container(container_runtime, rootdir, extra_build_args)
+        super().prepare_container(container_runtime, rootdir, extra_build_args)
+
+
+TUMBLEWEED = _TestImage(base=_TUMBLEWEED_BASE, containerfile=_containerfile("zypp-tw"))
+LEAP_LATEST = _TestImage(
+    base=_LEAP_LATEST_BASE, containerfile=_containerfile("zypp-leap")
+)
+BCI_BASE_LATEST = _TestImage(
+    base=_BCI_BASE_LATEST_BASE, containerfile=_containerfile("zypp-bci")
 )
 
 CONTAINER_IMAGES = [TUMBLEWEED, LEAP_LATEST, BCI_BASE_LATEST]
 
+# tests that do not depend on the distribution only run in Tumbleweed, unless
+# OBS_SCM_BRIDGE_FULL_MATRIX is set
+_SMOKE_TEST_IMAGES = (
+    CONTAINER_IMAGES if os.environ.get("OBS_SCM_BRIDGE_FULL_MATRIX") else [TUMBLEWEED]
+)
+
 
 _OBS_SCM_BRIDGE_CMD = "obs_scm_bridge --debug 1"
 
+_OUTPUT_SEPARATOR = "--- obs-scm-bridge-test ---"
+
+
+def _check_outputs(container: ContainerData, *commands: str) -> List[str]:
+    """Run all ``commands`` in the container using a single command invocation
+    instead of one per command and return their outputs with leading and
+    trailing whitespace stripped.
+
+    """
+    output = container.connection.check_output(
+        f" && echo '{_OUTPUT_SEPARATOR}' && ".join(commands)
+    )
+    return [out.strip() for out in output.split(_OUTPUT_SEPARATOR)]
+
+
+@pytest.fixture
+def clean_tmp(container: ContainerData) -> ContainerData:
+    """Remove the output of previous tests from the session wide container. The
+    tests only write into `/tmp`, so cleaning it up isolates them from each
+    other without launching a new container for every test.
 
-def test_service_help(auto_container: ContainerData):
+    """
+    container.connection.check_output(
+        "rm -rf /tmp/ring0 /tmp/scm-bridge /tmp/libeconf /tmp/lfs-example "
+        "/tmp/obs-scm-bridge*"
+    )
+    return container
+
+
+@pytest.mark.parametrize("container", _SMOKE_TEST_IMAGES, indirect=True)
+def test_service_help(container: ContainerData):
     """This is just a simple smoke test to check whether the script works."""
-    auto_container.connection.run_expect([0], f"{_OBS_SCM_BRIDGE_CMD} --help")
+    container.connection.run_expect([0], f"{_OBS_SCM_BRIDGE_CMD} --help")
 
 
-def test_clones_the_repository(auto_container_per_test: ContainerData):
+@pytest.mark.parametrize("container", _SMOKE_TEST_IMAGES, indirect=True)
+def test_clones_the_repository(clean_tmp: ContainerData):
     """Check that the service clones the manually created repository correctly."""
     dest = "/tmp/ring0"
-    auto_container_per_test.connection.run_expect(
+    clean_tmp.connection.run_expect(
         [0], f"{_OBS_SCM_BRIDGE_CMD} --outdir {dest} --url {_RPMS_DIR}ring0"
     )
     # delete _scmsync.obsinfo so that the diff succeeds
-    auto_container_per_test.connection.run_expect([0], f"rm {dest}/_scmsync.obsinfo")
-    auto_container_per_test.connection.run_expect([0], f"diff {dest} {_RPMS_DIR}ring0")
+    clean_tmp.connection.run_expect([0], f"rm {dest}/_scmsync.obsinfo")
+    clean_tmp.connection.run_expect([0], f"diff {dest} {_RPMS_DIR}ring0")
 
 
-@pytest.mark.parametrize("container_per_test", CONTAINER_IMAGES, indirect=True)
+@pytest.mark.parametrize("container", CONTAINER_IMAGES, indirect=True)
 @pytest.mark.parametrize(
     "fragment",
     (
@@ -79,37 +229,64 @@ def test_clones_the_repository(auto_container_per_test: ContainerData):
         "#9907826c17ca7b650c4040e9c2b45bfef4d9821f",
     ),
 )
-def test_clones_subdir(container_per_test: ContainerData, fragment: str):
+def test_clones_subdir(clean_tmp: ContainerData, fragment: str):
     dest = "/tmp/scm-bridge/"
-    container_per_test.connection.run_expect(
+    clean_tmp.connection.run_expect(
         [0],
         f"{_OBS_SCM_BRIDGE_CMD} --outdir {dest} "
-        f"--url https://github.com/openSUSE/obs-scm-bridge?subdir=test{fragment}",
+        f"--url {_OBS_SCM_BRIDGE_MIRROR}?subdir=test{fragment}",
     )
 
 
-def test_creates_packagelist(auto_container_per_test: ContainerData):
+def _head_hashes(manifest: str) -> Dict[str, str]:
+    """Parse the contents of the manifest into a mapping of package names to
+    their HEAD hashes.
+
+    """
+    return dict(line.split() for line in manifest.splitlines())
+
+
+def _test_pkg_xml(
+    pkg_xml: str, pkg_name: str, expected_url: str, expected_head_hash: str
+) -> None:
+    conf = ET.fromstring(pkg_xml)
+    assert conf.attrib["name"] == pkg_name
+    scm_sync_elements = conf.findall("scmsync")
+    assert len(scm_sync_elements) == 1 and scm_sync_elements[0].text
+    assert f"{expected_url}#{expected_head_hash}" in scm_sync_elements[0].text
+
+
+@pytest.mark.parametrize("container", _SMOKE_TEST_IMAGES, indirect=True)
+@pytest.mark.parametrize(
+    "pkg_name,expected_url",
+    [("aaa_base", _AAA_BASE_URL), ("libeconf", f"{_RPMS_DIR}libeconf")],
+)
+def test_creates_packagelist(
+    clean_tmp: ContainerData, pkg_name: str, expected_url: str
+):
     """Smoke test for the generation of the package list files `$pkg_name.xml`
     and `$pkg_name.info`:
 
     - verify that the destination folder contains all expected `.info` and
       `.xml` files
-    - check the `scmsync` elements in the `.xml` files
-    - check the HEAD hashes in the `.info` files
+    - check the `scmsync` element in the `.xml` file
+    - check the HEAD hash in the `.info` file
     """
     dest = "/tmp/ring0"
-    auto_container_per_test.connection.run_expect(
+    clean_tmp.connection.run_expect(
         [0],
         f"{_OBS_SCM_BRIDGE_CMD} --outdir {dest} --url {_RPMS_DIR}ring0 --projectmode 1",
     )
-    libeconf_hash, aaa_base_hash = (
-        auto_container_per_test.connection.file(
-            f"/src/{pkg_name}"
-        ).content_string.strip()
-        for pkg_name in ("libeconf", "aaa_base")
+
+    listing, manifest, pkg_xml, pkg_info = _check_outputs(
+        clean_tmp,
+        f"ls -A {dest}",
+        f"cat {_MANIFEST}",
+        f"cat {dest}/{pkg_name}.xml",
+        f"cat {dest}/{pkg_name}.info",
     )
 
-    files = auto_container_per_test.connection.file(dest).listdir()
+    files = listing.splitlines()
     assert len(files) == 4
     for file_name in (
         f"{pkg}.{ext}"
@@ -117,72 +294,51 @@ def test_creates_packagelist(auto_container_per_test: ContainerData):
     ):
         assert file_name in files
 
-    def _test_pkg_xml(pkg_name: str, expected_url: str, expected_head_hash: str):
-        conf = ET.fromstring(
-            auto_container_per_test.connection.file(
-                f"{dest}/{pkg_name}.xml"
-            ).content_string
-        )
-        assert conf.attrib["name"] == pkg_name
-        scm_sync_elements = conf.findall("scmsync")
-        assert len(scm_sync_elements) == 1 and scm_sync_elements[0].text
-        assert f"{expected_url}#{expected_head_hash}" in scm_sync_elements[0].text
+    pkg_head_hash = _head_hashes(manifest)[pkg_name]
+    _test_pkg_xml(pkg_xml, pkg_name, expected_url, pkg_head_hash)
+    assert pkg_head_hash == pkg_info
 
-    _test_pkg_xml("aaa_base", _AAA_BASE_URL, aaa_base_hash)
-    _test_pkg_xml("libeconf", f"{_RPMS_DIR}libeconf", libeconf_hash)
 
-    for pkg_name, pkg_head_hash in (
-        ("aaa_base", aaa_base_hash),
-        ("libeconf", libeconf_hash),
-    ):
-        assert (
-            pkg_head_hash
-            == auto_container_per_test.connection.file(
-                f"{dest}/{pkg_name}.info"
-            ).content_string.strip()
-        )
-
-
-LFS_REPO = "https://src.opensuse.org/pool/trivy.git"
+LFS_REPO = f"file://{_MIRRORS_DIR}trivy.git"
 
 
-@pytest.mark.parametrize("fragment", ["", "#a03edab0f045ed7be68faeddef7d7ecc9416592b"])
+@pytest.mark.parametrize("fragment", ["", f"#{_LFS_COMMIT}"])
 @pytest.mark.parametrize("query", ["", "?lfs=1"])
-@pytest.mark.parametrize("container_per_test", [TUMBLEWEED, LEAP_LATEST], indirect=True)
-def test_downloads_lfs(container_per_test: ContainerData, fragment: str, query: str):
-    """Test that the lfs file is automatically downloaded from the lfs server on
-    clone.
+@pytest.mark.parametrize("container", [TUMBLEWEED, LEAP_LATEST], indirect=True)
+def test_downloads_lfs(clean_tmp: ContainerData, fragment: str, query: str):
+    """Test that the lfs file is automatically fetched on clone (via git-lfs'
+    transfer adapter for the local `file://` mirror).
 
     """
     _DEST = "/tmp/lfs-example"
-    container_per_test.connection.run_expect(
+    clean_tmp.connection.run_expect(
         [0], f"{_OBS_SCM_BRIDGE_CMD} --outdir {_DEST} --url {LFS_REPO}{query}{fragment}"
     )
 
-    tar_archive = container_per_test.connection.file(f"{_DEST}/trivy-0.47.0.tar.zst")
+    tar_archive = clean_tmp.connection.file(f"{_DEST}/trivy-0.47.0.tar.zst")
     assert tar_archive.exists and tar_archive.is_file
     assert tar_archive.size > 10 * 1024
 
 
-@pytest.mark.parametrize("fragment", ["", "#a03edab0f045ed7be68faeddef7d7ecc9416592b"])
-def test_lfs_opt_out(auto_container_per_test: ContainerData, fragment: str):
+@pytest.mark.parametrize("container", [TUMBLEWEED, BCI_BASE_LATEST], indirect=True)
+@pytest.mark.parametrize("fragment", ["", f"#{_LFS_COMMIT}"])
+def test_lfs_opt_out(clean_tmp: ContainerData, fragment: str):
     _DEST = "/tmp/lfs-example"
-    auto_container_per_test.connection.run_expect(
+    clean_tmp.connection.run_expect(
         [0], f"{_OBS_SCM_BRIDGE_CMD} --outdir {_DEST} --url {LFS_REPO}?lfs=0{fragment}"
     )
 
-    tar_archive = auto_container_per_test.connection.file(
-        f"{_DEST}/trivy-0.47.0.tar.zst"
-    )
+    tar_archive = clean_tmp.connection.file(f"{_DEST}/trivy-0.47.0.tar.zst")
     assert tar_archive.exists and tar_archive.is_file
     assert tar_archive.size < 1024
     assert "version https://git-lfs.github.com/spec" in tar_archive.content_string
 
 
+@pytest.mark.parametrize("container", _SMOKE_TEST_IMAGES, indirect=True)
 @pytest.mark.parametrize(
     "git_repo_url,expected_head",
     [
-        (f"{_LIBECONF_URL}{fragment}", commit)
+        (f"{_LIBECONF_MIRROR}{fragment}", commit)
         for fragment, commit in (
             ("", None),
             ("#master", None),
@@ -192,7 +348,7 @@ def test_lfs_opt_out(auto_container_per_test: ContainerData, fragment: str):
     ],
 )
 def test_clone_commit(
-    auto_container_per_test: ContainerData,
+    clean_tmp: ContainerData,
     git_repo_url: str,
     expected_head: Optional[str],
 ):
@@ -201,41 +357,35 @@ def test_clone_commit(
 
     """
     _DEST = "/tmp/libeconf"
-    auto_container_per_test.connection.run_expect(
+    clean_tmp.connection.run_expect(
         [0], f"{_OBS_SCM_BRIDGE_CMD} --outdir {_DEST} --url {git_repo_url}"
     )
 
-    head = auto_container_per_test.connection.run_expect(
+    head = clean_tmp.connection.run_expect(
         [0], f"git -C {_DEST} rev-parse HEAD"
     ).stdout.strip()
 
     if expected_head:
         assert head == expected_head
     else:
-        libeconf_hash = auto_container_per_test.connection.file(
-            "/src/libeconf"
-        ).content_string.strip()
-        assert libeconf_hash == head
+        manifest = clean_tmp.connection.file(_MANIFEST).content_string
+        assert _head_hashes(manifest)["libeconf"] == head
 
 
+@pytest.mark.parametrize("container", _SMOKE_TEST_IMAGES, indirect=True)
 @pytest.mark.parametrize(
     "env_var,shallow",
     [("", True), ("OSC_VERSION=1", False)],
 )
-def test_fetch_depth(
-    auto_container_per_test: ContainerData, env_var: str, shallow: bool
-):
+def test_fetch_depth(clean_tmp: ContainerData, env_var: str, shallow: bool):
     _DEST = "/tmp/libeconf"
-    auto_container_per_test.connection.run_expect(
-        [0], f"{env_var} {_OBS_SCM_BRIDGE_CMD} --outdir {_DEST} --url {_LIBECONF_URL}"
+    clean_tmp.connection.run_expect(
+        [0],
+        f"{env_var} {_OBS_SCM_BRIDGE_CMD} --outdir {_DEST} --url {_LIBECONF_MIRROR}",
     )
 
-    history_length = len(
-        auto_container_per_test.connection.run_expect(
-            [0], f"git -C {_DEST} log --oneline"
-        )
-        .stdout.strip()
-        .splitlines()
+    history_length = int(
+        clean_tmp.connection.check_output(f"git -C {_DEST} rev-list --count HEAD")
     )
     if shallow:
         assert history_length == 1